@@ -1,18 +1,8 @@
-from logging import log
 import pandas as pd
 import numpy as np
-import scanpy as sc
-import matplotlib.pyplot as plt
-import seaborn as sns
 import anndata
-from scipy.stats import spearmanr, pearsonr, zscore
+from collections import namedtuple
 from loguru import logger
-from io import StringIO
-from concurrent.futures import ProcessPoolExecutor as Mtp
-from concurrent.futures import ThreadPoolExecutor as MtT
-import sh
-import h5py
-from tqdm import tqdm
 from typing import (
     Dict,
     List,
@@ -26,10 +16,62 @@ from typing import (
     Mapping,
     Callable,
 )
-import collections
-from xarray import corr
 from . import basic
 
+def _isinByCode(sr_label: pd.Series, values) -> np.ndarray:
+    """
+    categorical-code equivalent of `Series.isin`: an int comparison over codes
+    instead of a hashed string lookup per element. Cheap when the series is
+    already categorical.
+    """
+    if not isinstance(sr_label.dtype, pd.CategoricalDtype):
+        sr_label = sr_label.astype("category")
+    st_values = set(values)
+    ls_code = [i for i, x in enumerate(sr_label.cat.categories) if x in st_values]
+    return np.isin(sr_label.cat.codes.to_numpy(), ls_code)
+
+
+def _countCellsByVar(mtx) -> np.ndarray:
+    """
+    number of cells with a non-zero value per var. Dense input goes through
+    the fused np.count_nonzero reduction (no float accumulation, no boolean
+    intermediate the size of the matrix); sparse input only touches nnz flags.
+    """
+    import scipy.sparse as ss
+
+    if ss.issparse(mtx):
+        if ss.isspmatrix_csc(mtx):
+            # per-column segment sums over the non-zero flags
+            arNzCum = np.concatenate(([0], np.cumsum(mtx.data != 0, dtype=np.uint32)))
+            return np.diff(arNzCum[mtx.indptr])
+        mtx = mtx.tocsr()
+        return np.bincount(
+            mtx.indices[mtx.data != 0], minlength=mtx.shape[1]
+        ).astype(np.uint32)
+    return np.count_nonzero(mtx, axis=0).astype(np.uint32)
+
+
+def _addTestObsCols(df_obs, arIsTest, batchLabel, keyAdded):
+    """
+    add the test indicator column (and the batch compound column) as
+    categoricals built from codes, without any object-dtype string arrays.
+    """
+    df_obs[keyAdded] = pd.Categorical.from_codes(arIsTest, categories=["0", "1"])
+    if batchLabel:
+        sr_batch = df_obs[batchLabel].astype("category")
+        arCompound = sr_batch.cat.codes.to_numpy().astype(np.int32) * 2 + arIsTest
+        ls_categories = [
+            f"{batchCat}_{testCat}"
+            for batchCat in sr_batch.cat.categories
+            for testCat in ("0", "1")
+        ]
+        # drop unobserved batch x test combinations, which would otherwise
+        # surface as all-zero columns in the patsy design matrix
+        df_obs[f"{batchLabel}_{keyAdded}"] = pd.Categorical.from_codes(
+            arCompound, categories=ls_categories
+        ).remove_unused_categories()
+
+
 def parseAdToDiffxpyFormat(
     adata: anndata.AnnData,
     testLabel: str,
@@ -39,28 +81,27 @@ def parseAdToDiffxpyFormat(
     minCellCounts: int = 5,
     keyAdded: str = "temp",
     subset = True,
+    keepVarMask: Optional[np.ndarray] = None,
 ):
     if not otherComp:
         otherComp = list(adata.obs[testLabel].unique())
         otherComp = [x for x in otherComp if x != testComp]
     if isinstance(otherComp, str):
         otherComp = [otherComp]
+    arInComp = _isinByCode(adata.obs[testLabel], [testComp, *otherComp])
     if subset:
-        adata = adata[adata.obs[testLabel].isin([testComp, *otherComp])]
-        sc.pp.filter_genes(adata, min_cells=minCellCounts)
+        if keepVarMask is not None:
+            # caller already knows which genes pass: skip the matrix rescan
+            adata = adata[arInComp, keepVarMask].copy()
+        else:
+            import scanpy as sc
+
+            adata = adata[arInComp]
+            sc.pp.filter_genes(adata, min_cells=minCellCounts)
     else:
-        adata.obs['keep'] = adata.obs[testLabel].isin([testComp, *otherComp])
-    adata.obs = adata.obs.assign(
-        **{keyAdded: np.select([adata.obs[testLabel] == testComp], ["1"], "0")}
-    )
-    if batchLabel:
-        adata.obs = adata.obs.assign(
-            **{
-                f"{batchLabel}_{keyAdded}": adata.obs[batchLabel].astype(str)
-                + "_"
-                + adata.obs[keyAdded].astype(str)
-            }
-        )
+        adata.obs['keep'] = arInComp
+    arIsTest = (adata.obs[testLabel].to_numpy() == testComp).astype(np.int8)
+    _addTestObsCols(adata.obs, arIsTest, batchLabel, keyAdded)
     return adata
 
 def testTwoSample(
@@ -172,59 +213,92 @@ def vsRest(
         return pd.DataFrame if copy
     """
     import scipy.sparse as ss
-    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ProcessPoolExecutor, as_completed
     from multiprocessing.managers import SharedMemoryManager
-    from multiprocessing.shared_memory import SharedMemory
-    
+
     layer = "X" if not layer else layer
     if not groups:
         groups = list(adata.obs[testLabel].unique())
     if not keyAdded:
         keyAdded = f"diffxpyVsRest_{testLabel}"
-    ls_useCol = [testLabel]
-    if batchLabel:
-        ls_useCol.append(batchLabel)
-    if sizeFactor:
-        ls_useCol.append(batchLabel)
-    adataOrg = adata.copy() if copy else adata
+    ls_useCol = list(
+        dict.fromkeys(x for x in (testLabel, batchLabel, sizeFactor) if x)
+    )
+    adataOrg = adata
+    # getPartialLayersAdata already returns a fresh lightweight adata
     adata = basic.getPartialLayersAdata(adataOrg, layer, ls_useCol)
-    # adata.X = adata.X.A if ss.issparse(adata.X) else adata.X
+    adata.obs[testLabel] = adata.obs[testLabel].astype("category")
     if inputIsLog:
-        adata.X = ss.linalg.expm(adata.X) - 1 if ss.issparse(adata.X) else np.exp(adata.X) - 1
-    adata = adata[adata.obs[testLabel].isin(groups)].copy()
+        if ss.issparse(adata.X):
+            adata.X.data = np.expm1(adata.X.data)  # sparsity-preserving: expm1(0) == 0
+        else:
+            adata.X = np.expm1(adata.X)
+    arUseObs = _isinByCode(adata.obs[testLabel], groups)
+    if not arUseObs.all():
+        adata = adata[arUseObs].copy()
 
     logger.info("start performing test")
-    adataOrg.uns[keyAdded] = {"__cat": "vsRest"}
+    dt_result = {"__cat": "vsRest"}
 
     if threads > 1:
         dt_diffxpyResult = {}
-        mtx = adata.X.A if ss.issparse(adata.X) else adata.X
-        adata.X = ss.csr_matrix(adata.shape)
-        with SharedMemoryManager() as smm:
-            shm = smm.SharedMemory(mtx.nbytes)
-            shape = mtx.shape
-            dtype = mtx.dtype
-            mtxInShm = np.ndarray(shape=shape, dtype=dtype, buffer=shm.buf)
-            np.copyto(mtxInShm, mtx)
-            with ProcessPoolExecutor(threads) as mtp:
-                for singleGroup in groups:
-                    dt_diffxpyResult[singleGroup] = mtp.submit(
+        mtx = adata.X.tocsr() if ss.issparse(adata.X) else ss.csr_matrix(adata.X)
+        smm = SharedMemoryManager()
+        smm.start()
+        try:
+            ls_shm = _shareCsrTriplet(smm, mtx)
+            # every vsRest worker keeps all cells, so the gene filter is
+            # identical across groups: count cells per var once and broadcast
+            arKeepVar = _countCellsByVar(mtx) >= minCellCounts
+            ls_keepVarShm = _shareArray(smm, arKeepVar)
+            del mtx
+            arCodes, arUniques = pd.factorize(adata.obs[testLabel])
+            arCodes = arCodes.astype(np.int32)
+            dt_groupToCode = {x: i for i, x in enumerate(arUniques)}
+            ls_codeShm = _shareArray(smm, arCodes)
+            payload = _DiffxpyWorkerPayload(
+                nObs=adata.n_obs,
+                dt_obs={
+                    x: adata.obs[x].to_numpy()
+                    for x in ls_useCol
+                    if x != testLabel
+                },
+                arVarNames=adata.var_names.to_numpy(),
+                ls_shm=ls_shm,
+                ls_codeShm=ls_codeShm,
+                ls_keepVarShm=ls_keepVarShm,
+                dt_groupToCode=dt_groupToCode,
+            )
+            with ProcessPoolExecutor(
+                threads,
+                initializer=_initDiffxpyWorker,
+                initargs=(payload,),
+            ) as mtp:
+                dt_future = {
+                    mtp.submit(
                         _getDiffxpy,
-                        adata,
-                        testLabel,
                         singleGroup,
                         batchLabel=batchLabel,
                         minCellCounts=minCellCounts,
                         quickScale=quickScale,
                         sizeFactor=sizeFactor,
                         constrainModel=constrainModel,
-                        ls_shm = [shm.name, shape, dtype]
-                    )
+                    ): singleGroup
+                    for singleGroup in groups
+                }
+                for future in as_completed(dt_future):
+                    singleGroup = dt_future[future]
+                    dt_diffxpyResult[singleGroup] = future.result()
+                    logger.info(f"{singleGroup} done")
+        finally:
+            smm.shutdown()
         logger.info(f"get marker done")
-        dt_diffxpyResult = {x: y.result() for x, y in dt_diffxpyResult.items()}
-        adataOrg.uns[keyAdded].update(dt_diffxpyResult)
+        dt_result.update(dt_diffxpyResult)
     else:
         adata.X = adata.X.A if ss.issparse(adata.X) else adata.X
+        # each group is tested against all the others, so every call keeps the
+        # same cells and the gene filter can be computed a single time
+        arKeepVar = _countCellsByVar(adata.X) >= minCellCounts
         for singleGroup in groups:
             ad_test = parseAdToDiffxpyFormat(
                 adata,
@@ -233,6 +307,7 @@ def vsRest(
                 batchLabel=batchLabel,
                 minCellCounts=minCellCounts,
                 keyAdded="temp",
+                keepVarMask=arKeepVar,
             )
             test = testTwoSample(
                 ad_test,
@@ -242,10 +317,11 @@ def vsRest(
                 sizeFactor,
                 constrainModel=constrainModel,
             )
-            adataOrg.uns[keyAdded][singleGroup] = test
+            dt_result[singleGroup] = test
             logger.info(f"{singleGroup} done")
     if copy:
-        return adataOrg.uns[keyAdded]
+        return dt_result
+    adataOrg.uns[keyAdded] = dt_result
 
 def pairWise(
     adata: anndata.AnnData,
@@ -259,6 +335,7 @@ def pairWise(
     keyAdded: str = None,
     quickScale: bool = True,
     constrainModel: bool = False,
+    threads: int = 1,
     copy: bool = False,
 ) -> Optional[Dict[str, pd.DataFrame]]:
     """
@@ -293,70 +370,130 @@ def pairWise(
     Optional[Dict[str, pd.DataFrame]]
         return pd.DataFrame if copy
     """
-    from itertools import product
+    from itertools import combinations, product
     import scipy.sparse as ss
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing.managers import SharedMemoryManager
 
     layer = "X" if not layer else layer
     if not groups:
         groups = list(adata.obs[testLabel].unique())
     if not keyAdded:
         keyAdded = f"diffxpyPairWise_{testLabel}"
-    ls_useCol = [testLabel]
-    if batchLabel:
-        ls_useCol.append(batchLabel)
-    if sizeFactor:
-        ls_useCol.append(batchLabel)
-    adataOrg = adata.copy() if copy else adata
+    ls_useCol = list(
+        dict.fromkeys(x for x in (testLabel, batchLabel, sizeFactor) if x)
+    )
+    adataOrg = adata
+    # getPartialLayersAdata already returns a fresh lightweight adata
     adata = basic.getPartialLayersAdata(adataOrg, layer, ls_useCol)
-    adata.X = adata.X.A if ss.issparse(adata.X) else adata.X
-    if inputIsLog:
-        adata.X = np.exp(adata.X) - 1
-    adata = adata[adata.obs[testLabel].isin(groups)].copy()
+    adata.obs[testLabel] = adata.obs[testLabel].astype("category")
+    if ss.issparse(adata.X):
+        adata.X = adata.X.tocsc()  # gene filter is a column reduction
+        if inputIsLog:
+            adata.X.data = np.expm1(adata.X.data)  # sparsity-preserving: expm1(0) == 0
+    elif inputIsLog:
+        np.expm1(adata.X, out=adata.X)
+    arUseObs = _isinByCode(adata.obs[testLabel], groups)
+    if not arUseObs.all():
+        adata = adata[arUseObs].copy()
 
     logger.info("start performing test")
-    adataOrg.uns[keyAdded] = {"__cat": "pairWise"}
-    for x, y in product(range(len(groups)), range(len(groups))):
-        if (
-            x >= y
-        ):  # only calculate half combination of groups, then use these result to fullfill another half
-            continue
-        testGroup = groups[x]
-        backgroundGroup = groups[y]
-        ad_test = parseAdToDiffxpyFormat(
-            adata,
-            testLabel,
-            testGroup,
-            backgroundGroup,
-            batchLabel=batchLabel,
-            minCellCounts=minCellCounts,
-            keyAdded="temp",
-        )
-        test = testTwoSample(
-            ad_test,
-            "temp",
-            batchLabel,
-            quickScale,
-            sizeFactor,
-            constrainModel=constrainModel,
-        )
-        adataOrg.uns[keyAdded][f"test_{testGroup}_bg_{backgroundGroup}"] = test
-        logger.info(f"{testGroup} vs {backgroundGroup} done")
+    dt_result = {"__cat": "pairWise"}
+    if threads > 1:
+        dt_diffxpyResult = {}
+        mtx = adata.X.tocsr() if ss.issparse(adata.X) else ss.csr_matrix(adata.X)
+        smm = SharedMemoryManager()
+        smm.start()
+        try:
+            ls_shm = _shareCsrTriplet(smm, mtx)
+            del mtx
+            arCodes, arUniques = pd.factorize(adata.obs[testLabel])
+            arCodes = arCodes.astype(np.int32)
+            dt_groupToCode = {x: i for i, x in enumerate(arUniques)}
+            ls_codeShm = _shareArray(smm, arCodes)
+            payload = _DiffxpyWorkerPayload(
+                nObs=adata.n_obs,
+                dt_obs={
+                    x: adata.obs[x].to_numpy()
+                    for x in ls_useCol
+                    if x != testLabel
+                },
+                arVarNames=adata.var_names.to_numpy(),
+                ls_shm=ls_shm,
+                ls_codeShm=ls_codeShm,
+                ls_keepVarShm=None,  # pair gene filters differ, workers compute their own
+                dt_groupToCode=dt_groupToCode,
+            )
+            with ProcessPoolExecutor(
+                threads,
+                initializer=_initDiffxpyWorker,
+                initargs=(payload,),
+            ) as mtp:
+                dt_future = {
+                    mtp.submit(
+                        _getDiffxpyPair,
+                        groups[x],
+                        groups[y],
+                        batchLabel=batchLabel,
+                        minCellCounts=minCellCounts,
+                        quickScale=quickScale,
+                        sizeFactor=sizeFactor,
+                        constrainModel=constrainModel,
+                    ): (groups[x], groups[y])
+                    for x, y in combinations(range(len(groups)), 2)
+                }
+                for future in as_completed(dt_future):
+                    testGroup, backgroundGroup = dt_future[future]
+                    test = future.result()
+                    test.insert(0, "testedCluster", testGroup)
+                    test.insert(1, "bgCluster", backgroundGroup)
+                    dt_diffxpyResult[f"test_{testGroup}_bg_{backgroundGroup}"] = test
+                    logger.info(f"{testGroup} vs {backgroundGroup} done")
+        finally:
+            smm.shutdown()
+        dt_result.update(dt_diffxpyResult)
+    else:
+        for x, y in combinations(range(len(groups)), 2):
+            testGroup = groups[x]
+            backgroundGroup = groups[y]
+            ad_test = parseAdToDiffxpyFormat(
+                adata,
+                testLabel,
+                testGroup,
+                backgroundGroup,
+                batchLabel=batchLabel,
+                minCellCounts=minCellCounts,
+                keyAdded="temp",
+            )
+            if ss.issparse(ad_test.X):
+                ad_test.X = ad_test.X.A  # densify only the per-pair subset
+            test = testTwoSample(
+                ad_test,
+                "temp",
+                batchLabel,
+                quickScale,
+                sizeFactor,
+                constrainModel=constrainModel,
+            )
+            test.insert(0, "testedCluster", testGroup)
+            test.insert(1, "bgCluster", backgroundGroup)
+            dt_result[f"test_{testGroup}_bg_{backgroundGroup}"] = test
+            logger.info(f"{testGroup} vs {backgroundGroup} done")
     for x, y in product(range(len(groups)), range(len(groups))):
         if x <= y:  # use these result to fullfill another half
             continue
         testGroup = groups[x]
         backgroundGroup = groups[y]
-        adataOrg.uns[keyAdded][
-            f"test_{testGroup}_bg_{backgroundGroup}"
-        ] = adataOrg.uns[keyAdded][f"test_{backgroundGroup}_bg_{testGroup}"].copy()
-        adataOrg.uns[keyAdded][f"test_{testGroup}_bg_{backgroundGroup}"][
-            "log2fc"
-        ] = -adataOrg.uns[keyAdded][f"test_{testGroup}_bg_{backgroundGroup}"][
-            "log2fc"
-        ]
+        df_mirror = dt_result[f"test_{backgroundGroup}_bg_{testGroup}"]
+        dt_result[f"test_{testGroup}_bg_{backgroundGroup}"] = df_mirror.assign(
+            log2fc=-df_mirror["log2fc"],
+            testedCluster=testGroup,
+            bgCluster=backgroundGroup,
+        )
 
     if copy:
-        return adataOrg.uns[keyAdded]
+        return dt_result
+    adataOrg.uns[keyAdded] = dt_result
 
 
 def getMarker(
@@ -421,37 +558,39 @@ def getMarker(
         mean,
         detectedCounts=-1,
     ) -> pd.DataFrame:
-        import re
-
         ls_markerParsed = []
         ls_compName = []
         for comp, df_marker in dt_marker.items():
             if comp == "__cat":
                 continue
-            testedCluster = re.findall(r"test_([\w\W]+)_bg", comp)[0]
-            bgCluster = re.findall(r"_bg_([\w\W]+)", comp)[0]
-            ls_compName.append(bgCluster)
             if "testedCluster" not in df_marker.columns:
+                # results stored before the cluster names became columns
+                import re
+
+                testedCluster = re.findall(r"test_([\w\W]+)_bg", comp)[0]
+                bgCluster = re.findall(r"_bg_([\w\W]+)", comp)[0]
                 df_marker.insert(0, "testedCluster", testedCluster)
-            if "bgCluster" not in df_marker.columns:
                 df_marker.insert(1, "bgCluster", bgCluster)
+            if len(df_marker):
+                ls_compName.append(df_marker["bgCluster"].iat[0])
 
             df_marker = __twoSample(df_marker, qvalue, log2fc, mean)
             ls_markerParsed.append(df_marker)
-        df_markerMerged = pd.concat(ls_markerParsed)
+        df_markerMerged = pd.concat(ls_markerParsed).sort_values(
+            ["testedCluster", "gene"], kind="mergesort"
+        )
         df_markerMerged = (
-            df_markerMerged.groupby(["testedCluster", "gene"])
+            df_markerMerged.groupby(
+                ["testedCluster", "gene"], sort=False, observed=True
+            )
             .agg(
-                {
-                    "gene": "count",
-                    "bgCluster": lambda x: list(x),
-                    "qval": lambda x: list(x),
-                    "log2fc": lambda x: list(x),
-                    "mean": lambda x: list(x),
-                    "coef_mle": lambda x: list(x),
-                }
+                counts=("gene", "size"),
+                bgCluster=("bgCluster", list),
+                qval=("qval", list),
+                log2fc=("log2fc", list),
+                mean=("mean", list),
+                coef_mle=("coef_mle", list),
             )
-            .rename(columns={"gene": "counts"})
             .reset_index()
         )
         if detectedCounts <= 0:
@@ -469,38 +608,179 @@ def getMarker(
     return fc_parse(dt_marker, qvalue, log2fc, mean, detectedCounts)
 
 
+def _shareCsrTriplet(smm, mtx):
+    """
+    place the data/indices/indptr of a csr_matrix into SharedMemory buffers,
+    returning the metadata needed to rebuild the matrix in a worker.
+    """
+    ls_shmName = []
+    ls_shape = []
+    ls_dtype = []
+    for ar in (mtx.data, mtx.indices, mtx.indptr):
+        shm = smm.SharedMemory(ar.nbytes)
+        arInShm = np.ndarray(shape=ar.shape, dtype=ar.dtype, buffer=shm.buf)
+        np.copyto(arInShm, ar)
+        ls_shmName.append(shm.name)
+        ls_shape.append(ar.shape)
+        ls_dtype.append(ar.dtype)
+    return [ls_shmName, ls_shape, ls_dtype, mtx.shape]
+
+
+def _shareArray(smm, ar):
+    """place a numpy array into a SharedMemory buffer and return its metadata."""
+    shm = smm.SharedMemory(ar.nbytes)
+    arInShm = np.ndarray(shape=ar.shape, dtype=ar.dtype, buffer=shm.buf)
+    np.copyto(arInShm, ar)
+    return [shm.name, ar.shape, ar.dtype]
+
+
+def _arrayFromShm(ls_meta):
+    """rebuild an array from `_shareArray` metadata; keep the returned shm alive."""
+    from multiprocessing.shared_memory import SharedMemory
+
+    (shmName, shape, dtype) = ls_meta
+    shm = SharedMemory(shmName)
+    return np.ndarray(shape=shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _csrFromShm(ls_shm):
+    """
+    rebuild the shared csr_matrix from `_shareCsrTriplet` metadata; the returned
+    shm objects must stay alive as long as the matrix is in use.
+    """
+    import scipy.sparse as ss
+    from multiprocessing.shared_memory import SharedMemory
+
+    (ls_shmName, ls_shape, ls_dtype, globalShape) = ls_shm
+    ls_shmObj = [SharedMemory(x) for x in ls_shmName]
+    data, indices, indptr = (
+        np.ndarray(shape=shape, dtype=dtype, buffer=shm.buf)
+        for shape, dtype, shm in zip(ls_shape, ls_dtype, ls_shmObj)
+    )
+    return ss.csr_matrix((data, indices, indptr), shape=globalShape), ls_shmObj
+
+
+_WORKER_STATE = {}
+
+# everything a worker needs besides the shared matrix: the few obs columns the
+# wald formula references, var names for the result index, and the shm metadata
+_DiffxpyWorkerPayload = namedtuple(
+    "_DiffxpyWorkerPayload",
+    [
+        "nObs",
+        "dt_obs",
+        "arVarNames",
+        "ls_shm",
+        "ls_codeShm",
+        "ls_keepVarShm",
+        "dt_groupToCode",
+    ],
+)
+
+
+def _initDiffxpyWorker(payload):
+    """
+    runs once per worker process: rebuild a minimal adata skeleton from the
+    payload and keep the shared-memory metadata around for the workers.
+    """
+    df_obs = pd.DataFrame(payload.dt_obs, index=np.arange(payload.nObs).astype(str))
+    _WORKER_STATE["adata"] = anndata.AnnData(
+        obs=df_obs, var=pd.DataFrame(index=payload.arVarNames)
+    )
+    _WORKER_STATE["ls_shm"] = payload.ls_shm
+    _WORKER_STATE["ls_codeShm"] = payload.ls_codeShm
+    _WORKER_STATE["ls_keepVarShm"] = payload.ls_keepVarShm
+    _WORKER_STATE["dt_groupToCode"] = payload.dt_groupToCode
+
+
+_kernelColKeep = None
+
+
+def _getColKeepKernel():
+    """
+    compile (once per process) a numba kernel which counts, for every var,
+    the kept cells with a non-zero value, streaming the CSR triplet in one pass.
+    """
+    global _kernelColKeep
+    if _kernelColKeep is None:
+        import numba
+
+        @numba.njit(parallel=True, boundscheck=False)
+        def colKeep(data, indices, indptr, keepRows, nVar):
+            nThreads = numba.get_num_threads()
+            counts = np.zeros((nThreads, nVar), dtype=np.uint32)
+            for i in numba.prange(len(keepRows)):
+                if keepRows[i]:
+                    t = numba.get_thread_id()
+                    for k in range(indptr[i], indptr[i + 1]):
+                        if data[k] != 0:
+                            counts[t, indices[k]] += 1
+            return counts.sum(0)
+
+        _kernelColKeep = colKeep
+    return _kernelColKeep
+
+
 def _getDiffxpy(
-    adata,
-    testLabel,
     testComp,
     batchLabel,
     minCellCounts,
     quickScale,
     sizeFactor,
     constrainModel,
-    ls_shm
-):  
-    import scipy.sparse as ss
-    from multiprocessing.shared_memory import SharedMemory
-    ad_parsed = parseAdToDiffxpyFormat(
-        adata,
-        testLabel,
-        testComp,
-        batchLabel=batchLabel,
-        minCellCounts=minCellCounts,
-        keyAdded="temp",
-        subset=False
+):
+    adata = _WORKER_STATE["adata"]
+    dt_groupToCode = _WORKER_STATE["dt_groupToCode"]
+
+    arCodes, shmCodes = _arrayFromShm(_WORKER_STATE["ls_codeShm"])
+    adata.obs["keep"] = np.ones(len(arCodes), dtype=bool)  # vsRest uses all groups
+    arIsTest = (arCodes == dt_groupToCode[testComp]).astype(np.int8)
+    _addTestObsCols(adata.obs, arIsTest, batchLabel, "temp")
+
+    mtxInShm, ls_shmObj = _csrFromShm(_WORKER_STATE["ls_shm"])
+    ls_keep = adata.obs["keep"].to_numpy()
+    ls_keepVar, shmKeepVar = _arrayFromShm(_WORKER_STATE["ls_keepVarShm"])
+    ad_parsed = adata[ls_keep, ls_keepVar].copy()
+    ad_parsed.X = mtxInShm[ls_keep][:, ls_keepVar].A
+
+    df_diffxpyResult = testTwoSample(
+        ad_parsed,
+        "temp",
+        batchLabel,
+        quickScale,
+        sizeFactor,
+        constrainModel=constrainModel,
     )
+    return df_diffxpyResult
 
-    if not ls_shm:
-        adata.X = adata.X.A if ss.issparse(adata.X) else adata.X
-    else:
-        (shmName, shape, dtype) = ls_shm
-        shm = SharedMemory(shmName)
-        mtxInShm = np.ndarray(shape=shape, dtype=dtype, buffer=shm.buf)
-        ls_keepVar = mtxInShm[adata.obs['keep']].sum(0) > minCellCounts
-        ad_parsed.X = mtxInShm
-        ad_parsed = adata[adata.obs['keep'], ls_keepVar]
+
+def _getDiffxpyPair(
+    testComp,
+    bgComp,
+    batchLabel,
+    minCellCounts,
+    quickScale,
+    sizeFactor,
+    constrainModel,
+):
+    adata = _WORKER_STATE["adata"]
+    dt_groupToCode = _WORKER_STATE["dt_groupToCode"]
+
+    arCodes, shmCodes = _arrayFromShm(_WORKER_STATE["ls_codeShm"])
+    ls_keep = (arCodes == dt_groupToCode[testComp]) | (
+        arCodes == dt_groupToCode[bgComp]
+    )
+    arIsTest = (arCodes == dt_groupToCode[testComp]).astype(np.int8)
+    _addTestObsCols(adata.obs, arIsTest, batchLabel, "temp")
+
+    mtxInShm, ls_shmObj = _csrFromShm(_WORKER_STATE["ls_shm"])
+    colKeep = _getColKeepKernel()
+    ls_keepVar = (
+        colKeep(mtxInShm.data, mtxInShm.indices, mtxInShm.indptr, ls_keep, mtxInShm.shape[1])
+        >= minCellCounts
+    )
+    ad_parsed = adata[ls_keep, ls_keepVar].copy()
+    ad_parsed.X = mtxInShm[ls_keep][:, ls_keepVar].A
 
     df_diffxpyResult = testTwoSample(
         ad_parsed,